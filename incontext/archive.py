@@ -0,0 +1,92 @@
+import json
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from incontext.db import get_archive_repo, get_repo
+from incontext.repository import IntegrityError
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S' # the format of sqlite's CURRENT_TIMESTAMP, which postgres also accepts.
+
+
+def format_timestamp(value):
+    return value.strftime(TIMESTAMP_FORMAT) if isinstance(value, datetime) else value
+
+
+def archive_conversation(id, before):
+    '''Moves one conversation and its messages into the archive database, compressed. Returns False if it's gone or has had new messages since `before`.'''
+    from incontext.conversations import get_messages # imported here because conversations imports this module.
+
+    repo = get_repo()
+    with repo.transaction():
+        repo.lock_conversation(id) # before reading the messages, so none can be added while they're archived.
+        conversation = repo.get_conversation(id)
+        if conversation is None or repo.has_messages_since(id, before):
+            return False
+
+        messages = [
+            dict(
+                id=message['id'],
+                created=format_timestamp(message['created']),
+                content=message['content'],
+                human=message['human'],
+                input_tokens=message['input_tokens'],
+                output_tokens=message['output_tokens'],
+            )
+            for message in get_messages(id)
+        ]
+        conversation = dict(conversation, created=format_timestamp(conversation['created']))
+        get_archive_repo().add_archived_conversation(conversation, zlib.compress(json.dumps(messages).encode('utf-8'), 9))
+        # committed to the archive before it's deleted here, so a crash in between leaves a copy in both databases rather than in neither. the main database's copy is the one that's used.
+        repo.remove_archived_conversation(id, [message['id'] for message in messages])
+
+    return True
+
+
+def archive_idle_conversations(days):
+    before = (datetime.now(timezone.utc) - timedelta(days=days)).strftime(TIMESTAMP_FORMAT) # CURRENT_TIMESTAMP is in UTC.
+    count = sum(
+        archive_conversation(conversation['id'], before)
+        for conversation in get_repo().get_idle_conversations(before)
+    )
+    if count:
+        get_repo().reclaim_space()
+
+    return count
+
+
+def rehydrate_conversation(archived):
+    '''Moves an archived conversation back into the main database when it's opened. `archived` is its row from `get_archived_conversation`.'''
+    from incontext.conversations import encode_content
+
+    messages = []
+    for message in json.loads(zlib.decompress(archived['data']).decode('utf-8')):
+        message['content'], message['content_compressed'] = encode_content(message['content'])
+        messages.append(message)
+    conversation = dict(archived)
+    conversation['created'] = format_timestamp(conversation['created'])
+
+    try:
+        get_repo().restore_conversation(conversation, messages)
+    except IntegrityError:
+        pass # another request restored it first.
+    get_archive_repo().delete_archived_conversation(archived['id']) # only once it's back, like archiving in the other direction.
+
+
+@click.command('archive-conversations')
+@click.option('--days', type=int, default=None, help='Archive conversations idle for longer than this many days.')
+@with_appcontext
+def archive_conversations_command(days):
+    '''Move idle conversations into the compressed archive database.'''
+    if days is None:
+        days = current_app.config['ARCHIVE_AFTER_DAYS']
+    count = archive_idle_conversations(days)
+    click.echo(f'Archived {count} conversation(s).')
+
+
+def init_app(app):
+    '''Called by the app factory to register the archive command.'''
+    app.cli.add_command(archive_conversations_command)
@@ -5,7 +5,8 @@ from flask import (
 )
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from incontext.db import get_db
+from incontext.db import get_repo
+from incontext.repository import IntegrityError
 
 bp = Blueprint('auth', __name__, url_prefix='/auth') # creates a blueprint named `'auth'`. It's passed `__name__` to know where it's defined. The `url_prefix` will be prepended to all URLs associated with the bp.
 
@@ -14,7 +15,7 @@ def register():
     if request.method == 'POST':
         username = request.form['username'] # request.form is a special type of dict mapping submitted form keys and values.
         password = request.form['password']
-        db = get_db()
+        repo = get_repo()
         error = None
 
         if not username:
@@ -24,11 +25,8 @@ def register():
 
         if error is None:
             try:
-                db.execute(
-                    'INSERT INTO users (username, password) VALUES (?, ?)', (username, generate_password_hash(password)),
-                )
-                db.commit()
-            except db.IntegrityError: # this will occur if the username already exists. (username column has a uniqueness constraint.)
+                repo.create_user(username, generate_password_hash(password))
+            except IntegrityError: # this will occur if the username already exists. (username column has a uniqueness constraint.)
                 error = f'User {username} is already registered.'
             else:
                 return redirect(url_for('auth.login')) # `url_for` generates the URL for the login view based on its name. this allows you to change the URL later without changing other code that links to it.
@@ -42,11 +40,8 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        db = get_db()
         error = None
-        user = db.execute(
-            'SELECT * FROM users WHERE username = ?', (username,)
-            ).fetchone()
+        user = get_repo().get_user_by_username(username)
 
         if user is None:
             error = 'Incorrect username.'
@@ -69,9 +64,7 @@ def load_logged_in_user():
     if user_id is None:
         g.user = None
     else:
-        g.user = get_db().execute(
-            'SELECT * FROM users WHERE id = ?', (user_id,)
-        ).fetchone() # g.user lasts for the lasts for the length of the request.
+        g.user = get_repo().get_user(user_id) # g.user lasts for the lasts for the length of the request.
 
 @bp.route('/logout')
 def logout():
@@ -1,10 +1,14 @@
+import zlib
+
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, url_for
 )
 from werkzeug.exceptions import abort
 
+from incontext.archive import rehydrate_conversation
 from incontext.auth import login_required
-from incontext.db import get_db
+from incontext.db import close_db, get_archive_repo, get_repo
+from incontext.usage import check_quota, record_usage
 from openai import OpenAI
 import os
 
@@ -13,12 +17,13 @@ bp = Blueprint('conversations', __name__, url_prefix='/conversations')
 @bp.route('/')
 @login_required
 def index():
-    db = get_db()
-    conversations = db.execute(
-        'SELECT c.id, name, created, creator_id, username'
-        ' FROM conversations c JOIN users u ON c.creator_id = u.id'
-        ' ORDER BY created DESC'
-    ).fetchall()
+    conversations = get_repo().get_conversations(g.user['id'])
+    ids = {conversation['id'] for conversation in conversations}
+    conversations += [
+        conversation for conversation in get_archive_repo().get_archived_conversations(g.user['id'])
+        if conversation['id'] not in ids # left in the archive by an interrupted run. the live one is used.
+    ] # archived conversations are still listed, and restored when opened.
+    conversations.sort(key=lambda conversation: conversation['created'], reverse=True)
     return render_template('conversations/index.html', conversations=conversations)
 
 @bp.route('/create', methods=('GET', 'POST'))
@@ -34,24 +39,21 @@ def create():
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'INSERT INTO conversations (name, creator_id)'
-                ' VALUES (?, ?)',
-                (name, g.user['id'])
-            )
-            db.commit()
+            get_repo().create_conversation(name, g.user['id'])
             return redirect(url_for('conversations.index'))
 
     return render_template('conversations/create.html')
 
 def get_conversation(id, check_creator=True):
-    conversation = get_db().execute(
-        'SELECT c.id, name, created, creator_id, username'
-        ' FROM conversations c JOIN users u ON c.creator_id = u.id'
-        ' WHERE c.id = ?',
-        (id,)
-    ).fetchone()
+    conversation = get_repo().get_conversation(id)
+
+    if conversation is None:
+        archived = get_archive_repo().get_archived_conversation(id)
+        if archived is not None:
+            if check_creator and archived['creator_id'] != g.user['id']:
+                abort(403) # before restoring, so other users can't cause writes.
+            rehydrate_conversation(archived)
+            conversation = get_repo().get_conversation(id)
 
     if conversation is None:
         abort(404, f"Conversation id {id} doesn't exist.")
@@ -76,13 +78,7 @@ def update(id):
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'UPDATE conversations SET name = ?'
-                ' WHERE id = ?',
-                (name, id)
-            )
-            db.commit()
+            get_repo().update_conversation(id, name)
             return redirect(url_for('conversations.index'))
     
     return render_template('conversations/update.html', conversation=conversation)
@@ -91,10 +87,8 @@ def update(id):
 @login_required
 def delete(id):
     get_conversation(id)
-    db = get_db()
-    db.execute('DELETE FROM conversations WHERE id = ?', (id,))
-    db.commit()
-    delete_messages(id)
+    get_repo().delete_conversation(id) # also deletes its messages.
+    get_archive_repo().delete_archived_conversation(id) # so a copy left in the archive doesn't come back.
     return redirect(url_for('conversations.index'))
 
 @bp.route('/<int:id>', methods=('GET',))
@@ -105,25 +99,27 @@ def view(id):
     return render_template('conversations/view.html', conversation=conversation, messages=messages)
 
 
+def encode_content(content):
+    '''Returns the (content, content_compressed) pair to store for a message body. Bodies over the threshold are stored compressed.'''
+    threshold = current_app.config['MESSAGE_COMPRESSION_THRESHOLD']
+    if threshold is None or len(content) < threshold:
+        return content, None
+
+    return '', zlib.compress(content.encode('utf-8'))
+
+
 def get_messages(conversation_id):
-    messages = get_db().execute(
-        'SELECT m.id, m.content, m.human, m.created, c.creator_id'
-        ' FROM messages m'
-        ' JOIN conversations c'
-        ' ON m.conversation_id = c.id'
-        ' WHERE c.id = ?',
-        (conversation_id,)
-    ).fetchall()
+    messages = []
+    for message in get_repo().get_messages(conversation_id):
+        message = dict(message)
+        compressed = message.pop('content_compressed')
+        if compressed is not None:
+            message['content'] = zlib.decompress(compressed).decode('utf-8')
+        messages.append(message)
     
     return messages
 
 
-def delete_messages(conversation_id):
-    db = get_db()
-    db.execute('DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
-    db.commit()
-
-
 def get_credential(name):
     os_env_var = os.environ.get(name)
     if os_env_var is not None:
@@ -144,6 +140,8 @@ def get_agent_response(cid):
         content = message['content']
         conversation_history.append(dict(role=role, content=content))
     
+    close_db() # don't hold a database connection while waiting on the model. the next `get_repo` call gets a new one.
+
     openai_api_key = get_credential('OPENAI_API_KEY')
     client = OpenAI(api_key=openai_api_key)
     try:
@@ -151,7 +149,13 @@ def get_agent_response(cid):
             model='gpt-4.1-mini',
             input=conversation_history
         )
-        return dict(success=True, content=response.output_text)
+        usage = response.usage # keep the token counts instead of throwing them away.
+        return dict(
+            success=True,
+            content=response.output_text,
+            input_tokens=usage.input_tokens if usage else None,
+            output_tokens=usage.output_tokens if usage else None,
+        )
     except Exception as e:
         return dict(success=False, content=e)
     
@@ -169,13 +173,8 @@ def add_message(conversation_id):
     if error is not None:
         return error, 400
     else:
-        db = get_db()
-        db.execute(
-            'INSERT INTO messages (conversation_id, content, human)'
-            ' VALUES (?, ?, ?)',
-            (conversation_id, message_content, 1,)
-        )
-        db.commit()
+        content, content_compressed = encode_content(message_content)
+        get_repo().add_message(conversation_id, content, 1, content_compressed=content_compressed)
         return '', 200
 
 
@@ -183,15 +182,19 @@ def add_message(conversation_id):
 @login_required
 def agent_response(conversation_id):
     conversation = get_conversation(conversation_id) # To check the creator
+    error = check_quota(g.user) # before the upstream call, so a user over their quota or rate limit costs nothing.
+    if error is not None:
+        return error, 429
+
     agent_response = get_agent_response(conversation_id)
     if agent_response['success']:
-        db = get_db()
-        db.execute(
-            'INSERT INTO messages (conversation_id, content, human)'
-            'VALUES (?, ?, ?)',
-            (conversation_id, agent_response['content'], 0,)
-        )
-        db.commit()
+        content, content_compressed = encode_content(agent_response['content'])
+        get_repo().add_message(
+            conversation_id, content, 0,
+            agent_response['input_tokens'], agent_response['output_tokens'],
+            content_compressed=content_compressed,
+        ) # the token counts ride along in the insert that was happening anyway.
+        record_usage(g.user['id'], agent_response['input_tokens'] or 0, agent_response['output_tokens'] or 0) # in memory only; flushed to the usage table in batches.
         return {'content': agent_response['content']}, 200
     else:
         # print(agent_response['content']) # Log the error
@@ -1,38 +1,125 @@
 import os
 import sqlite3
+import threading
 from datetime import datetime
 
 import click
 from flask import current_app, g
+from flask.cli import with_appcontext
+
+from incontext.repository import BACKENDS, PostgresRepository
+
+_pool_lock = threading.Lock() # threaded workers can make their first requests at the same time, and each would otherwise open a pool of its own.
+
+
+def get_backend():
+    return BACKENDS[current_app.config['DATABASE_BACKEND']] # the repository class for the configured backend, `sqlite` or `postgresql`.
 
 
 def get_db():
     if 'db' not in g: # `g` is the application context global - a special object unique for each request. It is used for data that might be accessed by multiple functions during the request. This conditional ensures that for any given request there is only one connection to the database.
-        g.db = sqlite3.connect( # establishes a connection to the file pointed at by the `DATABASE` configuration key. This file doesn't have to exist yet, and won't until the database is initialized. (see protocol doc).
-            current_app.config['DATABASE'], # `current_app` is also a special object. It points to the Flask application handling the request. It's available because the project uses an application factory in `__init__.py`. `get_db` will be called while the application is handling a request. It's not being called outside of that context. Therefore `current_app` will be available.
-            detect_types=sqlite3.PARSE_DECLTYPES # Does things like parsing timestamps to python datetime objects because sqlite has only very few native data types (INTEGER, TEXT, REAL, and BLOB).
-        )
-        g.db.row_factory = sqlite3.Row # returns rows that behave like dicts, allowing access to the columns by name.
+        backend = get_backend()
+        if backend is PostgresRepository:
+            g.db = get_pool('db_pool').getconn() # borrowed from the pool for the length of the request, and given back in `close_db`.
+        else:
+            g.db = backend.connect(current_app.config['DATABASE']) # establishes a connection to the file pointed at by the `DATABASE` configuration key. This file doesn't have to exist yet, and won't until the database is initialized. (see protocol doc).
 
     return g.db
 
 
-def close_db(e=None):
-    '''Checks if a connection was created and closes it if so. Called by the application factory after each request.'''
-    db = g.pop('db', None)
+def get_archive_db():
+    '''The archive of idle conversations is a database of its own, so it doesn't take up space in the main database's pages, cache or backups.'''
+    if 'archive_db' not in g:
+        backend = get_backend()
+        if backend is PostgresRepository:
+            g.archive_db = get_pool(get_archive_pool_name()).getconn()
+        else:
+            g.archive_db = backend.connect(current_app.config['ARCHIVE_DATABASE'])
+
+    return g.archive_db
+
+
+def get_archive_pool_name():
+    return 'archive_pool' if current_app.config['ARCHIVE_DATABASE_URL'] is not None else 'db_pool' # without its own url the archive shares the main database.
+
+
+POOL_URLS = {
+    'db_pool': 'DATABASE_URL',
+    'archive_pool': 'ARCHIVE_DATABASE_URL',
+}
+
+
+def get_pool(name):
+    '''Returns this worker's postgres connection pool for `name`, opening it on first use.'''
+    pool = current_app.extensions.get(name)
+    if pool is None:
+        with _pool_lock:
+            pool = current_app.extensions.get(name) # checked again, another thread may have opened it while this one waited.
+            if pool is None:
+                pool = current_app.extensions[name] = PostgresRepository.create_pool(current_app.config[POOL_URLS[name]], current_app.config)
+
+    return pool
+
+
+def get_repo():
+    '''Returns the repository that views use for all data access, bound to this request's connection.'''
+    if 'repo' not in g:
+        g.repo = get_backend()(get_db())
+        g.repo.trace = g.get('sql_trace') # set by `profiling` when this request is being profiled.
+
+    return g.repo
+
 
-    if db is not None:
+def get_archive_repo():
+    '''The same repository class as `get_repo`, bound to the archive database. Only the archive methods are used on it.'''
+    if 'archive_repo' not in g:
+        g.archive_repo = get_backend()(get_archive_db())
+        g.archive_repo.trace = g.get('sql_trace')
+
+    return g.archive_repo
+
+
+def release_db(db, pool_name):
+    if db is None:
+        return
+
+    pool = current_app.extensions.get(pool_name)
+    if pool is not None:
+        try:
+            db.rollback() # connections are in autocommit mode, but a failed request may have left a transaction open.
+        finally:
+            pool.putconn(db) # always, so a broken connection doesn't leak out of the pool. the pool throws broken ones away.
+    else:
         db.close()
 
 
+def close_db(e=None):
+    '''Checks if connections were created and closes them (or gives them back to the pool) if so. Called by the application factory after each request.'''
+    g.pop('repo', None)
+    g.pop('archive_repo', None)
+    release_db(g.pop('db', None), 'db_pool')
+    release_db(g.pop('archive_db', None), get_archive_pool_name())
+
+
+def init_archive_db(clear=False):
+    '''Creates the archive table if it's missing. `clear` empties it, since archived conversations belong to users that `init_db` drops.'''
+    archive_repo = get_archive_repo()
+    with current_app.open_resource(archive_repo.archive_schema) as f:
+        archive_repo.executescript(f.read().decode('utf-8'))
+    if clear:
+        archive_repo.clear_archive()
+
+
 def init_db():
-    db = get_db() # returns a database connection
+    repo = get_repo() # returns the repository for the configured backend
 
-    with current_app.open_resource('schema.sql') as f: # `open_resource` opens a file relative to the `incontext` package
-        db.executescript(f.read().decode('utf-8'))
+    with current_app.open_resource(repo.schema) as f: # `open_resource` opens a file relative to the `incontext` package
+        repo.executescript(f.read().decode('utf-8'))
   
-    db.execute('INSERT INTO users (username, password) VALUES(?, ?)',('admin', os.environ.get('IC_ADMIN_PW')),)
-    db.commit()
+    repo.create_user('admin', os.environ.get('IC_ADMIN_PW'))
+    for name in get_migrations(repo):
+        repo.add_migration(name) # the schema is already up to date.
+    init_archive_db(clear=True)
 
 
 @click.command('init-db') # defines a command line command 
@@ -42,6 +129,37 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+def get_migrations(repo):
+    '''The backend's migration scripts, in the order they have to run.'''
+    directory = os.path.join(current_app.root_path, repo.migrations)
+    return sorted(name for name in os.listdir(directory) if name.endswith('.sql'))
+
+
+def migrate_db():
+    '''Brings an existing database up to the current schema without losing data. Returns the names of the scripts that ran.'''
+    repo = get_repo()
+    applied = repo.get_applied_migrations()
+    ran = []
+    for name in get_migrations(repo):
+        if name in applied:
+            continue
+        with current_app.open_resource(f'{repo.migrations}/{name}') as f:
+            repo.executescript(f.read().decode('utf-8'))
+        repo.add_migration(name)
+        ran.append(name)
+    init_archive_db() # the archive has a single table, so creating it when it's missing is all it needs.
+
+    return ran
+
+
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    '''Apply schema changes to an existing database.'''
+    ran = migrate_db()
+    click.echo(f"Applied {len(ran)} migration(s){': ' + ', '.join(ran) if ran else '.'}")
+
+
 # tell python how to interpret timestamp values in the database
 sqlite3.register_converter(
     "timestamp", lambda v: datetime.fromisoformat(v.decode())
@@ -52,3 +170,4 @@ def init_app(app):
     '''Called by the app factory to do these register actions on the app.'''
     app.teardown_appcontext(close_db) # register the `close_db` function with the process of cleaning up after returning the response
     app.cli.add_command(init_db_command) # registers the `init-db` command that can be called with the `flask` command
+    app.cli.add_command(migrate_db_command)
@@ -0,0 +1,13 @@
+ALTER TABLE users ADD COLUMN token_quota INTEGER;
+ALTER TABLE messages ADD COLUMN input_tokens INTEGER;
+ALTER TABLE messages ADD COLUMN output_tokens INTEGER;
+
+CREATE TABLE usage (
+	user_id INTEGER NOT NULL,
+	window_start INTEGER NOT NULL,
+	input_tokens INTEGER NOT NULL DEFAULT 0,
+	output_tokens INTEGER NOT NULL DEFAULT 0,
+	requests INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (user_id, window_start),
+	FOREIGN KEY (user_id) REFERENCES users (id)
+);
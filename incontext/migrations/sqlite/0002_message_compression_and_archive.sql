@@ -0,0 +1,3 @@
+ALTER TABLE messages ADD COLUMN content_compressed BLOB;
+
+CREATE INDEX conversations_creator_id ON conversations (creator_id);
@@ -0,0 +1,149 @@
+import cProfile
+import json
+import os
+import random
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import click
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+HEADER = 'X-Profile-Token' # send a token from `flask profile-token` in this header to profile one request on a live server.
+
+
+def get_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='incontext-profile')
+
+
+def should_profile():
+    '''Profile if turned on in config, if the request is sampled, or if it carries a valid signed token. Only the token can be used without restarting workers.'''
+    if current_app.config['PROFILE_ENABLED']:
+        return True
+
+    if random.random() < current_app.config['PROFILE_SAMPLE_RATE']:
+        return True
+
+    token = request.headers.get(HEADER)
+    if token is not None:
+        try:
+            get_serializer().loads(token, max_age=current_app.config['PROFILE_TOKEN_MAX_AGE'])
+        except BadSignature: # also covers expired tokens.
+            return False
+        return True
+
+    return False
+
+
+def start_profile():
+    if not should_profile():
+        return
+
+    g.sql_trace = [] # picked up by `get_repo`, which hands it to the repository to fill in.
+    g.profile_start = time.perf_counter()
+    g.profiler = cProfile.Profile()
+    try:
+        g.profiler.enable()
+    except ValueError: # another profiler is already active in this thread. the sql trace still works.
+        g.profiler = None
+
+
+def find_repeated_queries(trace, threshold):
+    '''Statements run `threshold` or more times in one request. The same statement with different params is the usual sign of an N+1 query.'''
+    counts = Counter(entry['sql'] for entry in trace)
+    repeated = []
+    for sql, count in counts.most_common():
+        if count < threshold:
+            break
+        entries = [entry for entry in trace if entry['sql'] == sql]
+        repeated.append(dict(
+            sql=sql,
+            count=count,
+            distinct_params=len({entry['params'] for entry in entries}), # 1 means the exact same query was repeated.
+            seconds=sum(entry['seconds'] for entry in entries),
+        ))
+
+    return repeated
+
+
+def record_status(response):
+    '''Notes the status for the report, and stops tracing so statements run by teardown functions after the response aren't counted.'''
+    if 'sql_trace' in g:
+        g.profile_status = response.status_code
+        repo = g.get('repo')
+        if repo is not None:
+            repo.trace = None
+
+    return response
+
+
+def finish_profile(e=None):
+    '''Writes a pstats dump and a json report of the sql trace to `PROFILE_DIR`. A teardown function, so requests that raise get a report too.'''
+    if 'sql_trace' not in g:
+        return
+
+    profiler = g.pop('profiler')
+    if profiler is not None:
+        profiler.disable()
+    trace = g.pop('sql_trace')
+    repo = g.get('repo')
+    if repo is not None:
+        repo.trace = None
+
+    try:
+        write_report(trace, profiler, e)
+    except Exception: # a report that can't be written mustn't fail the request.
+        current_app.logger.exception('Could not write profile report.')
+
+
+def write_report(trace, profiler, e):
+    directory = current_app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    name = '{}-{}-{}'.format(
+        datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S'),
+        request.endpoint or 'unknown',
+        uuid.uuid4().hex[:8], # several workers can write reports in the same second.
+    )
+
+    repeated = find_repeated_queries(trace, current_app.config['PROFILE_REPEAT_THRESHOLD'])
+    report = dict(
+        method=request.method,
+        path=request.path,
+        endpoint=request.endpoint,
+        status=g.pop('profile_status', 500 if e is not None else None), # no response was made if the exception wasn't handled.
+        error=repr(e) if e is not None else None,
+        seconds=time.perf_counter() - g.pop('profile_start'),
+        query_count=len(trace),
+        query_seconds=sum(entry['seconds'] for entry in trace),
+        queries=trace,
+        repeated_queries=repeated,
+        profile=f'{name}.prof' if profiler is not None else None,
+    )
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(directory, f'{name}.prof')) # open with `python -m pstats` or snakeviz.
+    with open(os.path.join(directory, f'{name}.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if repeated:
+        current_app.logger.warning(
+            'Repeated queries in %s %s: %s', request.method, request.path,
+            ', '.join(f"{query['count']}x {query['sql']!r}" for query in repeated)
+        )
+
+
+@click.command('profile-token')
+@with_appcontext
+def profile_token_command():
+    '''Print a signed token that turns on profiling for requests that send it.'''
+    click.echo(f'{HEADER}: {get_serializer().dumps("profile")}')
+
+
+def init_app(app):
+    '''Called by the app factory. Registered before the blueprints so the whole request, including loading the user, is profiled.'''
+    app.before_request(start_profile)
+    app.after_request(record_status)
+    app.teardown_request(finish_profile)
+    app.cli.add_command(profile_token_command)
@@ -0,0 +1,384 @@
+import functools
+import hashlib
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+
+
+class IntegrityError(Exception):
+    '''Raised by any backend when a write breaks a constraint, e.g. a username that is already taken.'''
+
+
+class TracedCursor:
+    '''Stands in for a cursor whose rows were already fetched so they could be counted.'''
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+class Repository:
+    '''All the SQL the app runs, written once. Backends only say how to talk to their database.
+
+    Queries use `?` placeholders; backends with a different paramstyle translate them in `_execute`.'''
+
+    schema = None # the schema file in the `incontext` package that `init_db` runs for this backend.
+    migrations = None # the directory in the `incontext` package with this backend's `migrate-db` scripts.
+    archive_schema = None # the schema file for the archive database.
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.trace = None # a list to append every statement to, with its timing and row count, while a request is being profiled.
+
+    def execute(self, sql, params=()):
+        if self.trace is None:
+            return self._execute(sql, params)
+
+        start = time.perf_counter()
+        cursor = self._execute(sql, params)
+        if cursor.description is not None: # fetch now so the row count and the time spent fetching are part of the trace.
+            rows = cursor.fetchall()
+            row_count = len(rows)
+            cursor = TracedCursor(rows)
+        else:
+            row_count = cursor.rowcount
+        self.trace.append(dict(
+            sql=sql,
+            params=hashlib.sha1(repr(params).encode('utf-8')).hexdigest()[:12], # only a fingerprint. params can hold password hashes and message content.
+            seconds=time.perf_counter() - start,
+            rows=row_count,
+        ))
+        return cursor
+
+    def _execute(self, sql, params):
+        raise NotImplementedError
+
+    def executescript(self, script):
+        raise NotImplementedError
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    @contextmanager
+    def transaction(self):
+        '''Groups several statements so they're committed, or rolled back, together.'''
+        try:
+            yield
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    # migrations
+
+    def get_applied_migrations(self):
+        self.execute('CREATE TABLE IF NOT EXISTS schema_migrations (name TEXT PRIMARY KEY)') # databases from before migrations existed don't have it.
+        self.commit()
+        return {row['name'] for row in self.execute('SELECT name FROM schema_migrations').fetchall()}
+
+    def add_migration(self, name):
+        self.execute('INSERT INTO schema_migrations (name) VALUES (?)', (name,))
+        self.commit()
+
+    # users
+
+    def get_user(self, id):
+        return self.execute('SELECT * FROM users WHERE id = ?', (id,)).fetchone()
+
+    def get_user_by_username(self, username):
+        return self.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+
+    def create_user(self, username, password):
+        self.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password))
+        self.commit()
+
+    def set_token_quota(self, id, token_quota):
+        self.execute('UPDATE users SET token_quota = ? WHERE id = ?', (token_quota, id))
+        self.commit()
+
+    # conversations
+
+    def get_conversations(self, creator_id):
+        return self.execute(
+            'SELECT c.id, name, created, creator_id, username'
+            ' FROM conversations c JOIN users u ON c.creator_id = u.id'
+            ' WHERE c.creator_id = ?'
+            ' ORDER BY created DESC',
+            (creator_id,)
+        ).fetchall()
+
+    def get_conversation(self, id):
+        return self.execute(
+            'SELECT c.id, name, created, creator_id, username'
+            ' FROM conversations c JOIN users u ON c.creator_id = u.id'
+            ' WHERE c.id = ?',
+            (id,)
+        ).fetchone()
+
+    def create_conversation(self, name, creator_id):
+        self.execute('INSERT INTO conversations (name, creator_id) VALUES (?, ?)', (name, creator_id))
+        self.commit()
+
+    def update_conversation(self, id, name):
+        self.execute('UPDATE conversations SET name = ? WHERE id = ?', (name, id))
+        self.commit()
+
+    def delete_conversation(self, id):
+        with self.transaction():
+            self.execute('DELETE FROM messages WHERE conversation_id = ?', (id,)) # messages first, so the foreign key holds on backends that enforce it.
+            self.execute('DELETE FROM conversations WHERE id = ?', (id,))
+
+    # messages
+
+    def get_messages(self, conversation_id):
+        return self.execute(
+            'SELECT m.id, m.content, m.content_compressed, m.human, m.created, m.input_tokens, m.output_tokens, c.creator_id'
+            ' FROM messages m'
+            ' JOIN conversations c'
+            ' ON m.conversation_id = c.id'
+            ' WHERE c.id = ?'
+            ' ORDER BY m.id',
+            (conversation_id,)
+        ).fetchall()
+
+    def add_message(self, conversation_id, content, human, input_tokens=None, output_tokens=None, content_compressed=None):
+        self.execute(
+            'INSERT INTO messages (conversation_id, content, content_compressed, human, input_tokens, output_tokens)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            (conversation_id, content, content_compressed, human, input_tokens, output_tokens)
+        )
+        self.commit()
+
+    # archival
+
+    def get_idle_conversations(self, before):
+        '''Conversations with no activity (creation or new messages) since `before`, a 'YYYY-MM-DD HH:MM:SS' string.'''
+        return self.execute(
+            'SELECT c.id, name, created, creator_id, username'
+            ' FROM conversations c JOIN users u ON c.creator_id = u.id'
+            ' WHERE c.created < ?'
+            ' AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.conversation_id = c.id AND m.created >= ?)',
+            (before, before)
+        ).fetchall()
+
+    def lock_conversation(self, id):
+        '''Stops messages being added to the conversation until the current transaction ends. In sqlite this takes the database's write lock.'''
+        self.execute('UPDATE conversations SET id = id WHERE id = ?', (id,))
+
+    def has_messages_since(self, conversation_id, before):
+        return self.execute(
+            'SELECT 1 FROM messages WHERE conversation_id = ? AND created >= ? LIMIT 1',
+            (conversation_id, before)
+        ).fetchone() is not None
+
+    def remove_archived_conversation(self, id, message_ids):
+        '''Deletes a conversation once it has been written to the archive. Run it inside `transaction`, after `lock_conversation`.'''
+        if message_ids:
+            self.execute(
+                f"DELETE FROM messages WHERE conversation_id = ? AND id IN ({', '.join('?' * len(message_ids))})",
+                (id, *message_ids)
+            ) # only the archived ones, so a message that slipped in can't be lost. deleting the conversation then fails on its foreign key.
+        self.execute('DELETE FROM conversations WHERE id = ?', (id,))
+
+    def reclaim_space(self):
+        '''Gives the pages freed by archiving back, so the database file actually gets smaller.'''
+        raise NotImplementedError
+
+    def restore_conversation(self, conversation, messages):
+        '''Puts an archived conversation and its messages back, keeping their ids so links to them still work.'''
+        with self.transaction():
+            self.execute(
+                'INSERT INTO conversations (id, name, creator_id, created) VALUES (?, ?, ?, ?)',
+                (conversation['id'], conversation['name'], conversation['creator_id'], conversation['created'])
+            )
+            for message in messages:
+                self.execute(
+                    'INSERT INTO messages (id, conversation_id, created, content, content_compressed, human, input_tokens, output_tokens)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (
+                        message['id'], conversation['id'], message['created'], message['content'], message['content_compressed'],
+                        message['human'], message['input_tokens'], message['output_tokens'],
+                    )
+                )
+
+    # the archive database
+
+    def add_archived_conversation(self, conversation, data):
+        '''`data` holds the conversation's messages, compressed. Replaces an earlier copy, left behind if archiving was interrupted before the conversation was deleted.'''
+        self.execute(
+            'INSERT INTO archived_conversations (id, creator_id, username, created, name, data) VALUES (?, ?, ?, ?, ?, ?)'
+            ' ON CONFLICT (id) DO UPDATE SET'
+            ' creator_id = excluded.creator_id, username = excluded.username, created = excluded.created,'
+            ' name = excluded.name, archived = CURRENT_TIMESTAMP, data = excluded.data',
+            (conversation['id'], conversation['creator_id'], conversation['username'], conversation['created'], conversation['name'], data)
+        )
+        self.commit()
+
+    def get_archived_conversations(self, creator_id):
+        '''Only the columns the index needs, not the compressed messages.'''
+        return self.execute(
+            'SELECT id, name, created, creator_id, username FROM archived_conversations WHERE creator_id = ?',
+            (creator_id,)
+        ).fetchall()
+
+    def get_archived_conversation(self, id):
+        return self.execute('SELECT * FROM archived_conversations WHERE id = ?', (id,)).fetchone()
+
+    def delete_archived_conversation(self, id):
+        self.execute('DELETE FROM archived_conversations WHERE id = ?', (id,))
+        self.commit()
+
+    def clear_archive(self):
+        self.execute('DELETE FROM archived_conversations')
+        self.commit()
+
+    # usage
+
+    def get_usage(self, user_id, tokens_since, requests_since):
+        '''The user's tokens in buckets starting at or after `tokens_since`, and requests in buckets starting at or after `requests_since`.'''
+        return self.execute(
+            'SELECT'
+            ' CAST(COALESCE(SUM(CASE WHEN window_start >= ? THEN input_tokens + output_tokens ELSE 0 END), 0) AS BIGINT) AS tokens,'
+            ' CAST(COALESCE(SUM(CASE WHEN window_start >= ? THEN requests ELSE 0 END), 0) AS BIGINT) AS requests' # postgres sums bigints to numeric.
+            ' FROM usage WHERE user_id = ? AND window_start >= ?',
+            (tokens_since, requests_since, user_id, min(tokens_since, requests_since))
+        ).fetchone()
+
+    def add_usage(self, rows):
+        '''Adds a batch of (user_id, window_start, input_tokens, output_tokens, requests) rows to the usage table in one transaction. `window_start` is the start of the bucket the counts fall in.'''
+        with self.transaction(): # on failure none of the batch is written, so the caller can keep it pending.
+            for row in rows:
+                self.execute(
+                    'INSERT INTO usage (user_id, window_start, input_tokens, output_tokens, requests)'
+                    ' VALUES (?, ?, ?, ?, ?)'
+                    ' ON CONFLICT (user_id, window_start) DO UPDATE SET'
+                    ' input_tokens = usage.input_tokens + excluded.input_tokens,'
+                    ' output_tokens = usage.output_tokens + excluded.output_tokens,'
+                    ' requests = usage.requests + excluded.requests',
+                    row
+                )
+
+
+class SQLiteRepository(Repository):
+    schema = 'schema.sql'
+    migrations = 'migrations/sqlite'
+    archive_schema = 'schema-archive.sql'
+
+    @staticmethod
+    def connect(database):
+        connection = sqlite3.connect(
+            database,
+            detect_types=sqlite3.PARSE_DECLTYPES # Does things like parsing timestamps to python datetime objects because sqlite has only very few native data types (INTEGER, TEXT, REAL, and BLOB).
+        )
+        connection.row_factory = sqlite3.Row # returns rows that behave like dicts, allowing access to the columns by name.
+        return connection
+
+    def _execute(self, sql, params):
+        try:
+            return self.connection.execute(sql, params)
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(str(e)) from e
+
+    def executescript(self, script):
+        self.connection.executescript(script)
+
+    def reclaim_space(self):
+        self.commit()
+        self.execute('VACUUM') # deleted rows only put their pages on sqlite's freelist. this rewrites the file without them.
+
+
+class PostgresRow(dict):
+    '''Lets postgres rows be read by column name or by position, like `sqlite3.Row`.'''
+
+    def __init__(self, names, values):
+        super().__init__(zip(names, values))
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._values[key]
+        return super().__getitem__(key)
+
+
+PLACEHOLDER_TOKENS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\?|%") # quoted strings and identifiers, `?` and `%`.
+
+
+@functools.lru_cache(maxsize=256)
+def to_pyformat(sql):
+    '''Turns `?` placeholders into psycopg's `%s`, leaving any `?` inside quotes alone, and escapes literal `%` as `%%`.'''
+    def replace(match):
+        token = match.group()
+        if token == '?':
+            return '%s'
+        return token.replace('%', '%%')
+
+    return PLACEHOLDER_TOKENS.sub(replace, sql)
+
+
+def postgres_row_factory(cursor):
+    names = [column.name for column in cursor.description or ()] # statements that return no rows have no description.
+    return lambda values: PostgresRow(names, values)
+
+
+class PostgresRepository(Repository):
+    schema = 'schema-postgresql.sql'
+    migrations = 'migrations/postgresql'
+    archive_schema = 'schema-archive-postgresql.sql'
+
+    @staticmethod
+    def create_pool(url, config):
+        '''Opens the connection pool. Called lazily on first use, so each gunicorn worker gets its own pool after forking.
+
+        Connections are in autocommit mode, so reads never leave a transaction open on a connection. Writes that belong together use `transaction`.'''
+        from psycopg_pool import ConnectionPool # optional dependency, only needed for this backend.
+
+        return ConnectionPool(
+            url,
+            min_size=config['DATABASE_POOL_MIN_SIZE'],
+            max_size=config['DATABASE_POOL_MAX_SIZE'],
+            kwargs=dict(row_factory=postgres_row_factory, autocommit=True),
+            open=True,
+        )
+
+    def _execute(self, sql, params):
+        import psycopg
+
+        try:
+            return self.connection.execute(to_pyformat(sql), params)
+        except psycopg.IntegrityError as e:
+            raise IntegrityError(str(e)) from e
+
+    def executescript(self, script):
+        self.connection.execute(script) # psycopg runs several statements in one call when no parameters are passed.
+
+    def commit(self):
+        pass # every statement commits by itself in autocommit mode, and `transaction` blocks commit when they end.
+
+    def rollback(self):
+        pass
+
+    @contextmanager
+    def transaction(self):
+        with self.connection.transaction():
+            yield
+
+    def lock_conversation(self, id):
+        self.execute('SELECT id FROM conversations WHERE id = ? FOR UPDATE', (id,)) # a no-op UPDATE wouldn't block the key-share lock that inserting a message takes.
+
+    def reclaim_space(self):
+        self.execute('VACUUM messages') # makes the dead rows' space reusable without `VACUUM FULL`'s exclusive lock. autocommit, since it can't run in a transaction.
+
+
+BACKENDS = {
+    'sqlite': SQLiteRepository,
+    'postgresql': PostgresRepository,
+}
@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS archived_conversations (
+	id INTEGER PRIMARY KEY, -- the id the conversation had, and gets back when it's restored.
+	creator_id INTEGER NOT NULL, -- no foreign key, the users are in the main database.
+	username TEXT NOT NULL,
+	created TIMESTAMP NOT NULL,
+	name TEXT NOT NULL,
+	archived TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	data BLOB NOT NULL -- the messages, as zlib-compressed json.
+);
+
+CREATE INDEX IF NOT EXISTS archived_conversations_creator_id ON archived_conversations (creator_id);
@@ -0,0 +1,51 @@
+DROP TABLE IF EXISTS archived_conversations CASCADE;
+DROP TABLE IF EXISTS schema_migrations CASCADE;
+DROP TABLE IF EXISTS usage CASCADE;
+DROP TABLE IF EXISTS messages CASCADE;
+DROP TABLE IF EXISTS conversations CASCADE;
+DROP TABLE IF EXISTS users CASCADE;
+
+CREATE TABLE users (
+	id INTEGER PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+	username TEXT UNIQUE NOT NULL,
+	password TEXT NOT NULL,
+	token_quota INTEGER
+);
+
+CREATE TABLE conversations (
+	id INTEGER PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+	creator_id INTEGER NOT NULL,
+	created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	name TEXT NOT NULL,
+	FOREIGN KEY (creator_id) REFERENCES users (id)
+);
+
+CREATE TABLE messages (
+	id INTEGER PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+	conversation_id INTEGER NOT NULL,
+	created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	content TEXT NOT NULL,
+	content_compressed BYTEA, -- zlib-compressed body of long messages. `content` is empty when this is set.
+	human INTEGER NOT NULL,
+	input_tokens INTEGER,
+	output_tokens INTEGER,
+	FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+);
+
+CREATE INDEX messages_conversation_id ON messages (conversation_id);
+
+CREATE TABLE usage (
+	user_id INTEGER NOT NULL,
+	window_start BIGINT NOT NULL, -- unix time the bucket the counts fall in starts at.
+	input_tokens BIGINT NOT NULL DEFAULT 0,
+	output_tokens BIGINT NOT NULL DEFAULT 0,
+	requests INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (user_id, window_start),
+	FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+CREATE INDEX conversations_creator_id ON conversations (creator_id);
+
+CREATE TABLE schema_migrations (
+	name TEXT PRIMARY KEY -- file names from `migrations/`. `init-db` marks them all as applied.
+);
@@ -1,11 +1,15 @@
+DROP TABLE IF EXISTS archived_conversations;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS conversations;
 DROP TABLE IF EXISTS messages;
+DROP TABLE IF EXISTS usage;
+DROP TABLE IF EXISTS schema_migrations;
 
 CREATE TABLE users (
 	id INTEGER PRIMARY KEY AUTOINCREMENT,
 	username TEXT UNIQUE NOT NULL,
-	password TEXT NOT NULL
+	password TEXT NOT NULL,
+	token_quota INTEGER
 );
 
 CREATE TABLE conversations (
@@ -21,6 +25,25 @@ CREATE TABLE messages (
 	conversation_id INTEGER NOT NULL,
 	created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
 	content TEXT NOT NULL,
+	content_compressed BLOB, -- zlib-compressed body of long messages. `content` is empty when this is set.
 	human INTEGER NOT NULL,
+	input_tokens INTEGER,
+	output_tokens INTEGER,
 	FOREIGN KEY (conversation_id) REFERENCES conversations (id)
 );
+
+CREATE TABLE usage (
+	user_id INTEGER NOT NULL,
+	window_start INTEGER NOT NULL, -- unix time the bucket the counts fall in starts at.
+	input_tokens INTEGER NOT NULL DEFAULT 0,
+	output_tokens INTEGER NOT NULL DEFAULT 0,
+	requests INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (user_id, window_start),
+	FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+CREATE INDEX conversations_creator_id ON conversations (creator_id);
+
+CREATE TABLE schema_migrations (
+	name TEXT PRIMARY KEY -- file names from `migrations/`. `init-db` marks them all as applied.
+);
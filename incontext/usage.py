@@ -0,0 +1,241 @@
+import atexit
+import os
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from incontext.db import get_repo
+
+
+class UsageTracker:
+    '''Keeps per-user token and request counters in memory and writes them to the `usage` table in batches from a background thread, so that recording usage never adds a database write to a request.
+
+    Counts are kept in short buckets, and quotas and rate limits are checked against the sum of the buckets in the last window, so both windows roll. Both hold across workers and nodes: what's in the db is re-read after every flush and whenever it's older than the flush interval, so a user can go over by at most what other workers haven't flushed yet.'''
+
+    def __init__(self, bucket, window, rate_limit_window, flush_interval, flush_batch_size):
+        self.bucket = bucket # length in seconds of the buckets usage is counted in. windows are rounded to whole buckets.
+        self.window = window # length in seconds of the rolling window that token quotas apply to.
+        self.rate_limit_window = rate_limit_window # length in seconds of the rolling window that rate limits apply to.
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self._lock = threading.Lock() # gunicorn can run threaded workers, so the counters are guarded.
+        self._flush_lock = threading.Lock() # so two threads never write the same pending counts.
+        self._seen = {} # user_id -> dict of the tokens and requests in the user's windows in the db as last read, and when they were read (`read_at`).
+        self._pending = {} # (user_id, bucket_start) -> dict of input tokens, output tokens and requests not yet flushed.
+        self._pending_count = 0
+        self._flushes = 0 # bumped by every flush, so a read of the db that raced one can be thrown away.
+        self._thread = None
+        self._thread_pid = None
+        self._wake = threading.Event() # set when a batch is full, so it's flushed without waiting out the interval.
+        self._stopping = threading.Event()
+
+    def bucket_start(self, now=None):
+        now = time.time() if now is None else now
+        return int(now // self.bucket) * self.bucket
+
+    def _since(self, window):
+        '''The start of the oldest bucket in a window that ends now.'''
+        return self.bucket_start() - max(window - self.bucket, 0)
+
+    def _refresh(self, user_id):
+        '''Re-reads the user's usage from the db if it's stale, so usage flushed by other workers counts too.'''
+        with self._lock:
+            seen = self._seen.get(user_id)
+            if seen is not None and time.monotonic() - seen['read_at'] < self.flush_interval:
+                return
+            flushes = self._flushes
+
+        row = get_repo().get_usage(user_id, self._since(self.window), self._since(self.rate_limit_window)) # outside the lock, so other threads' checks don't wait on the db.
+        read_at = time.monotonic()
+
+        with self._lock:
+            if self._flushes != flushes: # the row may be missing counts that were just flushed.
+                if user_id in self._seen:
+                    return # the flush added them to `seen` already.
+                read_at = 0 # used this once, and read again on the next check.
+            self._seen[user_id] = dict(tokens=row['tokens'], requests=row['requests'], read_at=read_at)
+
+    def _used(self, user_id):
+        '''Tokens used in the quota window and requests made in the rate limit window. Called with the lock held.'''
+        seen = self._seen.get(user_id) or dict(tokens=0, requests=0)
+        tokens_since = self._since(self.window)
+        requests_since = self._since(self.rate_limit_window)
+        tokens, requests = seen['tokens'], seen['requests']
+        for (pending_user_id, bucket_start), pending in self._pending.items():
+            if pending_user_id != user_id:
+                continue
+            if bucket_start >= tokens_since:
+                tokens += pending['input_tokens'] + pending['output_tokens']
+            if bucket_start >= requests_since:
+                requests += pending['requests']
+
+        return tokens, requests
+
+    def _add(self, user_id, **counts):
+        '''Called with the lock held.'''
+        pending = self._pending.setdefault(
+            (user_id, self.bucket_start()),
+            dict(input_tokens=0, output_tokens=0, requests=0)
+        )
+        for column, value in counts.items():
+            pending[column] += value
+        self._pending_count += 1
+        if self._pending_count >= self.flush_batch_size:
+            self._wake.set()
+
+    def tokens_used(self, user_id):
+        self._refresh(user_id)
+        with self._lock:
+            return self._used(user_id)[0]
+
+    def check(self, user_id, token_quota, rate_limit):
+        '''Returns an error message if the user may not make another upstream request right now, otherwise None. An allowed request is counted straight away.'''
+        self._refresh(user_id)
+        with self._lock:
+            tokens, requests = self._used(user_id)
+            if token_quota is not None and tokens >= token_quota:
+                return 'Token quota exceeded.'
+            if rate_limit is not None and requests >= rate_limit:
+                return 'Rate limit exceeded. Please wait a moment.'
+            self._add(user_id, requests=1) # no db write here, it's flushed with the rest.
+
+        return None
+
+    def record(self, user_id, input_tokens, output_tokens):
+        with self._lock:
+            self._add(user_id, input_tokens=input_tokens, output_tokens=output_tokens) # no db read here. `seen` is read on the next check.
+
+    def start(self, app):
+        '''Starts this process's flush thread if it isn't running. Called on first use rather than by the app factory, so every gunicorn worker starts its own after forking.'''
+        with self._lock:
+            if self._stopping.is_set() or (self._thread is not None and self._thread_pid == os.getpid()):
+                return
+            self._thread = threading.Thread(target=self._run, args=(app,), name='usage-flush', daemon=True) # daemon, so it never keeps a worker from exiting. `stop` flushes what's left.
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _run(self, app):
+        while not self._stopping.is_set():
+            self._wake.wait(max(self.flush_interval, 0.1)) # at least a little, so a zero interval doesn't spin.
+            self._wake.clear()
+            if self._stopping.is_set() or not self._pending_count:
+                continue
+            with app.app_context(): # for a db connection of its own.
+                try:
+                    self.flush()
+                except Exception: # the counts stay pending and are retried on the next wake.
+                    app.logger.exception('Could not flush usage counters.')
+
+    def stop(self):
+        '''Stops the flush thread, waiting for a flush that's under way to finish.'''
+        self._stopping.set()
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=10)
+
+    def flush(self):
+        '''Writes all pending counters to the db in a single transaction. Pending counts are only cleared once the write has succeeded.'''
+        if not self._flush_lock.acquire(blocking=False):
+            return 0 # another thread is flushing already.
+
+        try:
+            with self._lock:
+                rows = [
+                    (user_id, bucket_start, pending['input_tokens'], pending['output_tokens'], pending['requests'])
+                    for (user_id, bucket_start), pending in self._pending.items()
+                ]
+                pending_count = self._pending_count
+
+            if rows:
+                get_repo().add_usage(rows)
+
+            with self._lock:
+                # what was recorded while writing stays pending for the next flush.
+                for user_id, bucket_start, input_tokens, output_tokens, requests in rows:
+                    pending = self._pending[(user_id, bucket_start)]
+                    pending['input_tokens'] -= input_tokens
+                    pending['output_tokens'] -= output_tokens
+                    pending['requests'] -= requests
+                    if not any(pending.values()):
+                        del self._pending[(user_id, bucket_start)]
+                    seen = self._seen.get(user_id)
+                    if seen is not None:
+                        seen['tokens'] += input_tokens + output_tokens
+                        seen['requests'] += requests
+                        seen['read_at'] = 0 # re-read on the next check, to pick up other workers' flushes too, and let old buckets fall out of the windows.
+                self._pending_count -= pending_count
+                self._flushes += 1
+        finally:
+            self._flush_lock.release()
+
+        return len(rows)
+
+
+def get_tracker():
+    return current_app.extensions['usage']
+
+
+def check_quota(user):
+    '''Enforces the user's token quota and the rate limit before an upstream model call is made.'''
+    token_quota = user['token_quota'] if user['token_quota'] is not None else current_app.config['TOKEN_QUOTA'] # a quota set on the user overrides the default from config.
+    tracker = get_tracker()
+    error = tracker.check(user['id'], token_quota, current_app.config['RATE_LIMIT'])
+    tracker.start(current_app._get_current_object())
+    return error
+
+
+def record_usage(user_id, input_tokens, output_tokens):
+    tracker = get_tracker()
+    tracker.record(user_id, input_tokens, output_tokens)
+    tracker.start(current_app._get_current_object())
+
+
+def flush_usage_at_exit(app):
+    '''Registered with `atexit`, so pending usage is written when a gunicorn worker shuts down or restarts.'''
+    tracker = app.extensions['usage']
+    tracker.stop() # so the last flush doesn't race the thread's.
+    with app.app_context():
+        try:
+            tracker.flush()
+        except Exception:
+            app.logger.exception('Could not flush usage counters at exit.')
+
+
+@click.command('set-quota')
+@click.argument('username')
+@click.argument('quota')
+@with_appcontext
+def set_quota_command(username, quota):
+    '''Set a user's token quota per quota window. Pass `none` to go back to the default, TOKEN_QUOTA.'''
+    if quota.lower() == 'none':
+        token_quota = None
+    else:
+        try:
+            token_quota = int(quota)
+        except ValueError:
+            raise click.BadParameter('must be a number of tokens or `none`.', param_hint='QUOTA')
+
+    repo = get_repo()
+    user = repo.get_user_by_username(username)
+    if user is None:
+        raise click.ClickException(f'No user named {username}.')
+    repo.set_token_quota(user['id'], token_quota) # read with the user on every request, so it applies straight away.
+    click.echo(f"Set the token quota of {username} to {token_quota if token_quota is not None else 'the default'}.")
+
+
+def init_app(app):
+    '''Called by the app factory to set up usage tracking on the app.'''
+    app.extensions['usage'] = UsageTracker(
+        bucket=app.config['USAGE_BUCKET'],
+        window=app.config['TOKEN_QUOTA_WINDOW'],
+        rate_limit_window=app.config['RATE_LIMIT_WINDOW'],
+        flush_interval=app.config['USAGE_FLUSH_INTERVAL'],
+        flush_batch_size=app.config['USAGE_FLUSH_BATCH_SIZE'],
+    )
+    app.cli.add_command(set_quota_command)
+    if not app.testing: # tests create an app per test, and their databases are gone by the time the interpreter exits.
+        atexit.register(flush_usage_at_exit, app)
@@ -1,30 +1,85 @@
 import os
+import shutil
+import socket
+import subprocess
 import tempfile
 
 import pytest
 from incontext import create_app
-from incontext.db import get_db, init_db
+from incontext.db import get_repo, init_db
 
 with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
     _data_sql = f.read().decode('utf8')
 
-@pytest.fixture
-def app():
+@pytest.fixture(scope='session')
+def postgresql_url(tmp_path_factory):
+    '''A postgres server for the test session. Uses `POSTGRES_TEST_URL` if set, otherwise starts a throwaway local server.'''
+    pytest.importorskip('psycopg_pool')
+    url = os.environ.get('POSTGRES_TEST_URL')
+    if url is not None:
+        yield url
+        return
+
+    if shutil.which('initdb') is None or shutil.which('pg_ctl') is None:
+        pytest.skip('postgres is not installed and POSTGRES_TEST_URL is not set')
+
+    data_dir = tmp_path_factory.mktemp('postgres')
+    with socket.socket() as s: # ask the os for a free port
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+    subprocess.run(['initdb', '-D', data_dir, '-U', 'incontext', '-E', 'UTF8', '--auth=trust'], check=True, capture_output=True)
+    subprocess.run(
+        ['pg_ctl', '-D', data_dir, '-o', f'-p {port} -k {data_dir} -h localhost', '-w', 'start'],
+        check=True, capture_output=True
+    )
+    yield f'postgresql://incontext@localhost:{port}/postgres'
+    subprocess.run(['pg_ctl', '-D', data_dir, '-m', 'fast', 'stop'], check=True, capture_output=True)
+
+
+@pytest.fixture(scope='session')
+def postgresql_archive_url(postgresql_url):
+    '''A second database on the same server, for the archive.'''
+    import psycopg
+
+    with psycopg.connect(postgresql_url, autocommit=True) as connection:
+        if connection.execute("SELECT 1 FROM pg_database WHERE datname = 'incontext_archive'").fetchone() is None:
+            connection.execute('CREATE DATABASE incontext_archive')
+
+    return postgresql_url.rsplit('/', 1)[0] + '/incontext_archive'
+
+
+@pytest.fixture(params=['sqlite', 'postgresql']) # every test that uses the app runs against both backends.
+def app(request):
     db_fd, db_path = tempfile.mkstemp() # creates and opens a temporary file 
+    archive_fd, archive_path = tempfile.mkstemp()
 
-    app = create_app({
+    test_config = {
         'TESTING': True, # tells Flask that the app is in test mode. makes testing better in Flask, and also tapped by extensions.
+        'DATABASE_BACKEND': request.param,
         'DATABASE': db_path, # override so it points to the temp path instead of the instance folder. 
-    })
+        'ARCHIVE_DATABASE': archive_path,
+    }
+    if request.param == 'postgresql':
+        test_config['DATABASE_URL'] = request.getfixturevalue('postgresql_url') # skips the postgres run if no server is available.
+        test_config['ARCHIVE_DATABASE_URL'] = request.getfixturevalue('postgresql_archive_url')
+
+    app = create_app(test_config)
 
-    with app.app_context(): # create the test db (at the temp file path)
+    with app.app_context(): # create the test db (at the temp file path, or in the postgres server)
         init_db()
-        get_db().executescript(_data_sql)
+        get_repo().executescript(_data_sql)
 
     yield app
 
-    os.close(db_fd) # test is over. close and remove the temp file.
+    app.extensions['usage'].stop() # before its database goes away.
+    for name in ('db_pool', 'archive_pool'):
+        pool = app.extensions.get(name)
+        if pool is not None:
+            pool.close()
+    os.close(db_fd) # test is over. close and remove the temp files.
     os.unlink(db_path)
+    os.close(archive_fd)
+    os.unlink(archive_path)
 
 @pytest.fixture
 def client(app): # that's the application object created by the app fixture.
@@ -0,0 +1,122 @@
+import os
+
+import pytest
+from incontext.archive import archive_conversation, archive_idle_conversations
+from incontext.db import get_archive_repo, get_repo
+from incontext.repository import Repository
+
+
+def make_idle(app):
+    with app.app_context():
+        repo = get_repo()
+        repo.execute("UPDATE messages SET created = '2025-01-02 00:00:00'")
+        repo.commit()
+
+
+def count(app, table):
+    with app.app_context():
+        repo = get_archive_repo() if table == 'archived_conversations' else get_repo() # the archive is a database of its own.
+        return repo.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+def test_recent_conversation_not_archived(app):
+    with app.app_context():
+        assert archive_idle_conversations(30) == 0 # the test messages were just created.
+
+
+def test_archive_command(runner, app):
+    make_idle(app)
+    result = runner.invoke(args=['archive-conversations', '--days', '30'])
+    assert 'Archived 1 conversation(s).' in result.output
+
+    assert count(app, 'conversations') == 0
+    assert count(app, 'messages') == 0
+    with app.app_context():
+        archived = get_archive_repo().get_archived_conversation(1)
+        assert archived['name'] == 'test name'
+        assert archived['username'] == 'test'
+        assert b'Working' not in bytes(archived['data']) # the messages are stored compressed.
+
+
+def test_message_added_after_selection_not_archived(client, auth, app):
+    make_idle(app)
+    auth.login()
+    client.post('/conversations/1/add-message', json={'content': 'still here'}) # arrives after the conversation was picked as idle.
+
+    with app.app_context():
+        assert archive_conversation(1, '2025-06-01 00:00:00') is False
+
+    assert count(app, 'messages') == 3
+    assert count(app, 'archived_conversations') == 0
+
+
+def test_archived_conversation_listed_and_rehydrated(client, auth, app):
+    make_idle(app)
+    with app.app_context():
+        archive_idle_conversations(30)
+
+    auth.login()
+    response = client.get('/conversations/')
+    assert b'test name' in response.data # still listed while archived.
+    assert b'Created: 01.01.2025' in response.data
+
+    response = client.get('/conversations/1') # opening it brings it back.
+    assert response.status_code == 200
+    assert b'How can I assist you today?' in response.data
+
+    with app.app_context():
+        assert get_repo().execute('SELECT COUNT(*) FROM messages WHERE conversation_id = 1').fetchone()[0] == 2
+    assert count(app, 'archived_conversations') == 0
+
+
+def test_archived_conversation_must_be_creator(client, auth, app):
+    with app.app_context():
+        repo = get_repo()
+        repo.execute('UPDATE conversations SET creator_id = 3 WHERE id = 1')
+        repo.commit()
+    make_idle(app)
+    with app.app_context():
+        archive_idle_conversations(30)
+
+    auth.login()
+    assert client.get('/conversations/1').status_code == 403
+    # the other user's conversation stays archived.
+    assert count(app, 'archived_conversations') == 1
+    assert count(app, 'conversations') == 0
+
+
+def test_archiving_shrinks_database(app):
+    if app.config['DATABASE_BACKEND'] != 'sqlite':
+        pytest.skip('postgres reuses the space instead of giving it back')
+
+    with app.app_context():
+        repo = get_repo()
+        for i in range(500):
+            repo.add_message(1, os.urandom(2000).hex(), 1)
+    make_idle(app)
+    size = os.path.getsize(app.config['DATABASE'])
+
+    with app.app_context():
+        assert archive_idle_conversations(30) == 1
+
+    assert os.path.getsize(app.config['DATABASE']) < size / 10 # the freed pages are given back, not kept on sqlite's freelist.
+
+
+def test_interrupted_archive_keeps_conversation(client, auth, app, monkeypatch):
+    def fail(self, id, message_ids):
+        raise RuntimeError('crashed after writing the archive')
+    monkeypatch.setattr(Repository, 'remove_archived_conversation', fail)
+    make_idle(app)
+
+    with app.app_context():
+        with pytest.raises(RuntimeError):
+            archive_idle_conversations(30)
+
+    assert count(app, 'conversations') == 1
+    assert count(app, 'messages') == 2
+    assert count(app, 'archived_conversations') == 1 # the copy left behind.
+
+    auth.login()
+    assert client.get('/conversations/').data.count(b'test name') == 1 # listed once, from the main database.
+    client.post('/conversations/1/delete')
+    assert count(app, 'archived_conversations') == 0 # and the copy doesn't come back after a delete.
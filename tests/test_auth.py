@@ -1,6 +1,6 @@
 import pytest
 from flask import g, session
-from incontext.db import get_db
+from incontext.db import get_repo
 
 def test_register(client, app):
     assert client.get('/auth/register').status_code == 200 # the register view should render successfully on GET
@@ -10,7 +10,7 @@ def test_register(client, app):
     assert response.headers["Location"] == "/auth/login" # the register view should redirect to the login URL on POST.
 
     with app.app_context():
-        assert get_db().execute(
+        assert get_repo().execute(
             "SELECT * FROM users WHERE username = 'a'",
         ).fetchone() is not None # the user's data should be in the database.
 
@@ -1,5 +1,8 @@
+from types import SimpleNamespace
+
 import pytest
-from incontext.db import get_db
+from flask import g
+from incontext.db import get_repo
 
 
 def test_index(client, auth):
@@ -40,7 +43,7 @@ def test_view_conversation(app, client, auth):
     
     # forbid conv page to non-creator user
     with app.app_context():
-        db = get_db()
+        db = get_repo()
         db.execute('UPDATE conversations SET creator_id = 3 WHERE id = 1')
         db.commit()
     assert client.get('/conversations/1').status_code == 403
@@ -53,7 +56,7 @@ def test_create_conversation(client, auth, app):
     response = client.post('conversations/create', data={'name': 'created'})
 
     with app.app_context():
-        db = get_db()
+        db = get_repo()
         count = db.execute('SELECT COUNT(id) FROM conversations').fetchone()[0]
         assert count == 2
     
@@ -65,7 +68,7 @@ def test_update_conversation(client, auth, app):
     client.post('/conversations/1/update', data={'name': 'updated'})
 
     with app.app_context():
-        db = get_db()
+        db = get_repo()
         conversation = db.execute('SELECT * FROM conversations WHERE id = 1').fetchone()
         assert conversation['name'] == 'updated'
 
@@ -106,7 +109,7 @@ def test_modify_conversation_must_exist(client, auth, path):
 def test_modify_conversation_must_be_creator(app, client, auth):
     # change the conversation creator to another user
     with app.app_context():
-        db = get_db()
+        db = get_repo()
         db.execute('UPDATE conversations SET creator_id = 3 WHERE id = 1')
         db.commit()
 
@@ -125,7 +128,7 @@ def test_add_message(client, auth, app):
     response = client.post('/conversations/1/add-message', json={'content': 'hello'})
     assert response.status_code == 200
     with app.app_context():
-        db = get_db()
+        db = get_repo()
         count = db.execute('SELECT COUNT(id) FROM messages').fetchone()[0]
         assert count == 3
 
@@ -142,7 +145,7 @@ def test_agent_response(client, auth, app):
     assert response.status_code == 200
     assert response.json == {'content': 'Working'}
     with app.app_context():
-        db = get_db()
+        db = get_repo()
         count = db.execute('SELECT COUNT(id) FROM messages').fetchone()[0]
         assert count == 3
 
@@ -155,9 +158,47 @@ def test_delete(client, auth, app): # the delete view should should redirect to
     response = client.post('/conversations/1/delete')
     assert response.headers['Location'] == '/conversations/'
     with app.app_context():
-        db = get_db()
+        db = get_repo()
         conversation = db.execute('SELECT * FROM conversations WHERE id = 1').fetchone()
         assert conversation is None
         # messages whould be deleted
         count = db.execute('SELECT COUNT(id) FROM messages WHERE conversation_id = 1').fetchone()[0]
         assert count == 0
+
+
+def test_message_compression(client, auth, app):
+    app.config['MESSAGE_COMPRESSION_THRESHOLD'] = 100
+    auth.login()
+    long_message = 'hello ' * 100
+    client.post('/conversations/1/add-message', json={'content': 'short'})
+    client.post('/conversations/1/add-message', json={'content': long_message})
+
+    with app.app_context():
+        db = get_repo()
+        short, long = db.execute('SELECT * FROM messages WHERE id > 2 ORDER BY id').fetchall()
+        assert short['content'] == 'short'
+        assert short['content_compressed'] is None
+        assert long['content'] == '' # stored compressed instead.
+        assert len(long['content_compressed']) < len(long_message)
+
+    response = client.get('/conversations/1')
+    assert long_message.strip().encode() in response.data # decoded transparently.
+
+
+def test_agent_response_releases_db_connection(client, auth, app, monkeypatch):
+    class FakeResponses:
+        def create(self, model, input):
+            assert 'db' not in g # no connection is held while waiting on the model.
+            return SimpleNamespace(output_text='Working', usage=SimpleNamespace(input_tokens=3, output_tokens=1))
+
+    class FakeOpenAI:
+        def __init__(self, api_key):
+            self.responses = FakeResponses()
+
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    monkeypatch.setattr('incontext.conversations.OpenAI', FakeOpenAI)
+    auth.login()
+    response = client.post('/conversations/1/agent-response')
+    assert response.json == {'content': 'Working'}
+    with app.app_context():
+        assert get_repo().execute('SELECT COUNT(id) FROM messages').fetchone()[0] == 3
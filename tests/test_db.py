@@ -1,12 +1,19 @@
 import sqlite3
 import os
+import threading
+import time
 
 import pytest
-from incontext.db import get_db
+from incontext.conversations import get_messages
+from incontext.db import get_archive_repo, get_db, get_repo
+from incontext.repository import IntegrityError, PostgresRepository, SQLiteRepository, to_pyformat
 from flask import g, session
 
 
 def test_get_close_db(app):
+    if app.config['DATABASE_BACKEND'] != 'sqlite':
+        pytest.skip('postgres connections go back to the pool instead of being closed')
+
     with app.app_context():
         db = get_db()
         assert db is get_db() # within an application context, `get_db` should return the same connection each time it's called.
@@ -16,6 +23,65 @@ def test_get_close_db(app):
 
     assert 'closed' in str(e.value) # After the context, the connection should be closed.
 
+def test_get_repo(app):
+    with app.app_context():
+        repo = get_repo()
+        assert repo is get_repo()
+        assert repo.connection is get_db() # the repository uses the request's connection.
+        assert isinstance(repo, SQLiteRepository) == (app.config['DATABASE_BACKEND'] == 'sqlite')
+
+
+def test_pool_reuses_connections(app):
+    if app.config['DATABASE_BACKEND'] != 'postgresql':
+        pytest.skip('only postgres uses a connection pool')
+
+    from psycopg.pq import TransactionStatus
+
+    for i in range(5):
+        with app.app_context():
+            db = get_db()
+            get_repo().get_user(1)
+            assert db.info.transaction_status == TransactionStatus.IDLE # reads don't leave a transaction open.
+        assert not db.closed # the connection was given back to the pool, not closed.
+
+    stats = app.extensions['db_pool'].get_stats()
+    assert stats['pool_size'] <= app.config['DATABASE_POOL_MAX_SIZE']
+
+
+def test_pool_opened_once_across_threads(app, monkeypatch):
+    if app.config['DATABASE_BACKEND'] != 'postgresql':
+        pytest.skip('only postgres uses a connection pool')
+
+    created = []
+    create_pool = PostgresRepository.create_pool
+    def counting_create_pool(url, config):
+        created.append(url)
+        time.sleep(0.1) # widens the window in which another thread could open a second pool.
+        return create_pool(url, config)
+    monkeypatch.setattr(PostgresRepository, 'create_pool', staticmethod(counting_create_pool))
+
+    app.extensions.pop('db_pool').close() # the fixture opened one already.
+    barrier = threading.Barrier(8)
+    errors = []
+
+    def first_request():
+        barrier.wait() # all threads make their first request at once, like a fresh threaded worker.
+        try:
+            with app.app_context():
+                get_repo().get_user(1)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=first_request) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == [] # every connection went back to the pool it came from.
+    assert len(created) == 1
+
+
 def test_init_db_command(runner, monkeypatch):
     class Recorder:
         called = False
@@ -37,3 +103,81 @@ def test_admin_login(client, auth):
         assert session['user_id'] == 1
         assert g.user['username'] == 'admin'
 
+
+
+# the schema as it was before migrations were added.
+OLD_SCHEMA = {
+    'sqlite': '''
+        DROP TABLE IF EXISTS archived_conversations;
+        DROP TABLE IF EXISTS usage;
+        DROP TABLE IF EXISTS schema_migrations;
+        DROP TABLE IF EXISTS messages;
+        DROP TABLE IF EXISTS conversations;
+        DROP TABLE IF EXISTS users;
+        CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, password TEXT NOT NULL);
+        CREATE TABLE conversations (id INTEGER PRIMARY KEY AUTOINCREMENT, creator_id INTEGER NOT NULL, created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, name TEXT NOT NULL);
+        CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, conversation_id INTEGER NOT NULL, created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, content TEXT NOT NULL, human INTEGER NOT NULL);
+    ''',
+    'postgresql': '''
+        DROP TABLE IF EXISTS archived_conversations, usage, schema_migrations, messages, conversations, users CASCADE;
+        CREATE TABLE users (id INTEGER PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY, username TEXT UNIQUE NOT NULL, password TEXT NOT NULL);
+        CREATE TABLE conversations (id INTEGER PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY, creator_id INTEGER NOT NULL REFERENCES users (id), created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, name TEXT NOT NULL);
+        CREATE TABLE messages (id INTEGER PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY, conversation_id INTEGER NOT NULL REFERENCES conversations (id), created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, content TEXT NOT NULL, human INTEGER NOT NULL);
+    ''',
+}
+
+
+def test_migrate_db_command(runner, app):
+    with app.app_context():
+        repo = get_repo()
+        repo.executescript(OLD_SCHEMA[app.config['DATABASE_BACKEND']])
+        repo.create_user('old', 'hash')
+        repo.execute("INSERT INTO conversations (name, creator_id) VALUES ('old', 1)")
+        repo.execute("INSERT INTO messages (conversation_id, content, human) VALUES (1, 'kept', 1)")
+        repo.commit()
+        get_archive_repo().executescript('DROP TABLE archived_conversations') # an archive database that was never set up.
+
+    result = runner.invoke(args=['migrate-db'])
+    assert 'Applied' in result.output
+    assert '0001_token_usage.sql' in result.output
+    assert '0002_message_compression_and_archive.sql' in result.output
+
+    with app.app_context():
+        repo = get_repo()
+        assert repo.get_user_by_username('old')['token_quota'] is None # the new columns exist and the data is kept.
+        message, = get_messages(1)
+        assert message['content'] == 'kept'
+        assert message['input_tokens'] is None
+        assert len(repo.get_conversations(1)) == 1
+        assert repo.get_usage(1, 0, 0)['tokens'] == 0
+        assert get_archive_repo().get_archived_conversations(1) == []
+
+    assert 'Applied 0 migration(s).' in runner.invoke(args=['migrate-db']).output # running it again is safe.
+
+
+def test_init_db_marks_migrations_applied(runner, app):
+    assert 'Applied 0 migration(s).' in runner.invoke(args=['migrate-db']).output
+
+
+def test_to_pyformat():
+    assert to_pyformat('SELECT * FROM users WHERE id = ?') == 'SELECT * FROM users WHERE id = %s'
+    assert to_pyformat("SELECT '?', \"a?\" FROM t WHERE a = ?") == "SELECT '?', \"a?\" FROM t WHERE a = %s" # quoted `?` is left alone.
+    assert to_pyformat("SELECT 'it''s ?' WHERE a LIKE 'a%' AND b = ?") == "SELECT 'it''s ?' WHERE a LIKE 'a%%' AND b = %s"
+
+
+def test_literal_placeholder_characters(app):
+    with app.app_context():
+        count = get_repo().execute(
+            "SELECT COUNT(*) FROM users WHERE username LIKE 'te%' AND password <> '?' AND id = ?", (2,)
+        ).fetchone()[0]
+        assert count == 1
+
+
+def test_transaction_rolls_back(app):
+    with app.app_context():
+        repo = get_repo()
+        with pytest.raises(IntegrityError):
+            with repo.transaction():
+                repo.execute("UPDATE users SET username = 'renamed' WHERE id = 2")
+                repo.execute("INSERT INTO users (username, password) VALUES ('other', 'x')") # already taken.
+        assert repo.get_user(2)['username'] == 'test'
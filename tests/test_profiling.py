@@ -0,0 +1,84 @@
+import json
+import os
+import pstats
+
+import pytest
+from incontext.profiling import HEADER, find_repeated_queries
+
+
+@pytest.fixture
+def profile_dir(app, tmp_path):
+    app.config['PROFILE_DIR'] = str(tmp_path)
+    return tmp_path
+
+
+def read_reports(profile_dir):
+    reports = []
+    for name in sorted(os.listdir(profile_dir)):
+        if name.endswith('.json'):
+            with open(profile_dir / name) as f:
+                reports.append(json.load(f))
+    return reports
+
+
+def test_not_profiled_by_default(client, auth, profile_dir):
+    auth.login()
+    client.get('/conversations/1')
+    assert os.listdir(profile_dir) == []
+
+
+def test_profile_enabled(client, auth, app, profile_dir):
+    auth.login()
+    app.config['PROFILE_ENABLED'] = True
+    assert client.get('/conversations/1').status_code == 200
+
+    report, = read_reports(profile_dir)
+    assert report['endpoint'] == 'conversations.view'
+    assert report['status'] == 200
+    # load_logged_in_user, get_conversation and get_messages.
+    assert report['query_count'] == 3
+    assert [query['rows'] for query in report['queries']] == [1, 1, 2]
+    assert report['repeated_queries'] == []
+    pstats.Stats(str(profile_dir / report['profile'])) # a valid pstats dump.
+
+
+def test_profile_token(client, auth, runner, profile_dir):
+    auth.login()
+    client.get('/', headers={HEADER: 'not a valid token'})
+    assert read_reports(profile_dir) == []
+
+    token = runner.invoke(args=['profile-token']).output.split(': ')[1].strip()
+    client.get('/', headers={HEADER: token})
+    report, = read_reports(profile_dir)
+    assert report['endpoint'] == 'home.index'
+
+
+def test_find_repeated_queries():
+    trace = [
+        dict(sql='SELECT * FROM users WHERE id = ?', params='a', seconds=0.1, rows=1),
+        dict(sql='SELECT * FROM messages WHERE id = ?', params='a', seconds=0.1, rows=1),
+        dict(sql='SELECT * FROM messages WHERE id = ?', params='b', seconds=0.1, rows=1),
+        dict(sql='SELECT * FROM messages WHERE id = ?', params='c', seconds=0.1, rows=1),
+    ]
+    repeated, = find_repeated_queries(trace, 2)
+    assert repeated['sql'] == 'SELECT * FROM messages WHERE id = ?'
+    assert repeated['count'] == 3
+    assert repeated['distinct_params'] == 3
+    assert find_repeated_queries(trace, 4) == []
+
+
+def test_profile_request_that_raises(client, auth, app, profile_dir, monkeypatch):
+    def broken(conversation_id):
+        raise RuntimeError('broken view')
+
+    monkeypatch.setattr('incontext.conversations.get_messages', broken)
+    auth.login()
+    app.config['PROFILE_ENABLED'] = True
+    with pytest.raises(RuntimeError): # TESTING propagates the exception instead of answering with a 500.
+        client.get('/conversations/1')
+
+    report, = read_reports(profile_dir)
+    assert report['status'] == 500
+    assert 'broken view' in report['error']
+    assert report['query_count'] == 2 # the user and the conversation were loaded before it failed.
+    pstats.Stats(str(profile_dir / report['profile']))
@@ -0,0 +1,187 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+from flask import g
+from incontext.db import get_repo
+from incontext.usage import flush_usage_at_exit, get_tracker
+
+
+def fake_agent_response(cid):
+    return dict(success=True, content='Working', input_tokens=30, output_tokens=10)
+
+
+def test_agent_response_records_usage(client, auth, app, monkeypatch):
+    monkeypatch.setattr('incontext.conversations.get_agent_response', fake_agent_response) # so no real api call is made.
+    auth.login()
+    response = client.post('/conversations/1/agent-response')
+    assert response.json == {'content': 'Working'}
+
+    with app.app_context():
+        db = get_repo()
+        message = db.execute('SELECT * FROM messages ORDER BY id DESC').fetchone()
+        assert message['input_tokens'] == 30
+        assert message['output_tokens'] == 10
+        # nothing is written to the usage table until a flush is due.
+        assert db.execute('SELECT COUNT(*) FROM usage').fetchone()[0] == 0
+        assert get_tracker().tokens_used(2) == 40
+
+
+def wait_for_usage(app, user_id):
+    '''Waits for the background thread to flush the user's usage.'''
+    for i in range(100):
+        with app.app_context():
+            usage = get_repo().execute('SELECT * FROM usage WHERE user_id = ?', (user_id,)).fetchone()
+        if usage is not None:
+            return usage
+        time.sleep(0.05)
+
+
+def test_usage_flushed_in_batches(client, auth, app, monkeypatch):
+    app.extensions['usage'].flush_batch_size = 4 # the request and the response it gets are counted separately.
+    monkeypatch.setattr('incontext.conversations.get_agent_response', fake_agent_response)
+    auth.login()
+    client.post('/conversations/1/agent-response')
+    time.sleep(0.2)
+    with app.app_context():
+        assert get_repo().execute('SELECT COUNT(*) FROM usage').fetchone()[0] == 0 # half a batch waits for the interval.
+
+    client.post('/conversations/1/agent-response')
+    usage = wait_for_usage(app, 2) # a full batch wakes the thread.
+    assert usage['input_tokens'] == 60
+    assert usage['output_tokens'] == 20
+    assert usage['requests'] == 2
+
+
+def test_usage_flushed_after_interval(client, auth, app, monkeypatch):
+    app.extensions['usage'].flush_interval = 0.2
+    monkeypatch.setattr('incontext.conversations.get_agent_response', fake_agent_response)
+    auth.login()
+    client.post('/conversations/1/agent-response')
+    assert wait_for_usage(app, 2)['input_tokens'] == 30
+
+
+def test_flush_usage_at_exit(app):
+    with app.app_context():
+        get_tracker().record(2, 5, 5)
+    flush_usage_at_exit(app)
+    with app.app_context():
+        assert get_repo().execute('SELECT input_tokens FROM usage WHERE user_id = 2').fetchone()[0] == 5
+
+
+def test_failed_flush_keeps_usage_pending(client, auth, app, monkeypatch):
+    monkeypatch.setattr('incontext.conversations.get_agent_response', fake_agent_response)
+    app.extensions['usage'].flush_batch_size = 1
+    failed = threading.Event()
+
+    def fail(self, rows):
+        failed.set()
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr('incontext.repository.Repository.add_usage', fail)
+    auth.login()
+    assert client.post('/conversations/1/agent-response').status_code == 200
+    assert failed.wait(5)
+    app.extensions['usage'].stop() # so the retry below is the only one.
+
+    monkeypatch.undo()
+    with app.app_context():
+        assert get_tracker().flush() == 1
+        usage = get_repo().execute('SELECT * FROM usage WHERE user_id = 2').fetchone()
+        assert usage['input_tokens'] == 30
+        assert usage['requests'] == 1
+
+
+def test_quota_counts_usage_flushed_after_first_read(client, auth, app, monkeypatch):
+    app.config['TOKEN_QUOTA'] = 100
+    app.extensions['usage'].flush_interval = 0 # re-read on every check.
+    monkeypatch.setattr('incontext.conversations.get_agent_response', fake_agent_response)
+    auth.login()
+    assert client.post('/conversations/1/agent-response').status_code == 200 # the counter has been read and holds 40 tokens.
+
+    with app.app_context():
+        get_repo().add_usage([(2, get_tracker().bucket_start(), 50, 20, 1)]) # another worker flushes 70 tokens.
+
+    response = client.post('/conversations/1/agent-response')
+    assert response.status_code == 429
+    assert b'Token quota exceeded.' in response.data
+
+
+@pytest.mark.parametrize(('config', 'token_quota'), (
+    ({'TOKEN_QUOTA': 100}, None),
+    ({'TOKEN_QUOTA': None}, 100), # a quota on the user applies without a default.
+    ({'TOKEN_QUOTA': 1000000}, 100), # and overrides the default.
+))
+def test_token_quota(client, auth, app, monkeypatch, config, token_quota):
+    app.config.update(config)
+    monkeypatch.setattr('incontext.conversations.get_agent_response', fake_agent_response)
+    with app.app_context():
+        db = get_repo()
+        db.execute('UPDATE users SET token_quota = ? WHERE id = 2', (token_quota,))
+        # usage flushed by another worker counts too.
+        db.execute(
+            'INSERT INTO usage (user_id, window_start, input_tokens, output_tokens, requests) VALUES (2, ?, 70, 20, 1)',
+            (get_tracker().bucket_start(),)
+        )
+        db.commit()
+
+    auth.login()
+    assert client.post('/conversations/1/agent-response').status_code == 200 # 90 used, under quota.
+    response = client.post('/conversations/1/agent-response') # 130 used.
+    assert response.status_code == 429
+    assert b'Token quota exceeded.' in response.data
+
+
+def test_rate_limit(client, auth, app, monkeypatch):
+    app.config['RATE_LIMIT'] = 2
+    monkeypatch.setattr('incontext.conversations.get_agent_response', fake_agent_response)
+    auth.login()
+    assert client.post('/conversations/1/agent-response').status_code == 200
+    assert client.post('/conversations/1/agent-response').status_code == 200
+    response = client.post('/conversations/1/agent-response')
+    assert response.status_code == 429
+    assert b'Rate limit exceeded.' in response.data
+
+    # other users aren't affected by one heavy user.
+    with app.app_context():
+        assert get_tracker().check(3, None, 2) is None
+
+
+def test_rate_limit_shared_between_workers(client, auth, app, monkeypatch):
+    app.config['RATE_LIMIT'] = 2
+    monkeypatch.setattr('incontext.conversations.get_agent_response', fake_agent_response)
+    with app.app_context():
+        get_repo().add_usage([(2, get_tracker().bucket_start(), 0, 0, 2)]) # another worker flushes 2 requests.
+
+    auth.login()
+    response = client.post('/conversations/1/agent-response')
+    assert response.status_code == 429
+    assert b'Rate limit exceeded.' in response.data
+
+
+def test_quota_window_rolls(app):
+    with app.app_context():
+        tracker = get_tracker()
+        now = tracker.bucket_start()
+        get_repo().add_usage([
+            (2, now - tracker.window, 1000, 0, 1), # fell out of the window one bucket ago.
+            (2, now - tracker.window + tracker.bucket, 100, 0, 1), # the oldest bucket still in it.
+            (2, now, 10, 0, 1),
+        ])
+        assert tracker.tokens_used(2) == 110
+
+
+def test_set_quota_command(runner, app):
+    result = runner.invoke(args=['set-quota', 'test', '500'])
+    assert 'Set the token quota of test to 500.' in result.output
+    with app.app_context():
+        assert get_repo().get_user_by_username('test')['token_quota'] == 500
+
+    result = runner.invoke(args=['set-quota', 'test', 'none'])
+    assert 'to the default' in result.output
+    with app.app_context():
+        assert get_repo().get_user_by_username('test')['token_quota'] is None
+
+    assert runner.invoke(args=['set-quota', 'nobody', '500']).exit_code != 0
+    assert runner.invoke(args=['set-quota', 'test', 'lots']).exit_code != 0